@@ -5,24 +5,43 @@ Analyzes logwatch output using OpenAI API and sends alerts only when issues are
 """
 
 import os
+import array
+import asyncio
+import functools
 import json
+import random
+import re
+import select
 import subprocess
 import logging
-import smtplib
 import time
 import fcntl
 import socket
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+from datetime import datetime
 from pathlib import Path
-from typing import Optional, Dict, Any
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from typing import Optional, Dict, Any, List, Tuple, ClassVar
 
+# openai, smtplib and email.mime are imported lazily inside the methods that
+# need them: cron starts a cold interpreter nightly, and on a clean day the
+# prefilter short-circuits before any of them are used
+
+# orjson parses/serializes several times faster than the stdlib and produces
+# bytes directly; fall back to stdlib json when it is not installed
 try:
-    from openai import OpenAI
+    import orjson
+
+    def _json_loads(data):
+        return orjson.loads(data)
+
+    def _json_dumps(obj, indent: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
 except ImportError:
-    print("Error: OpenAI library not installed. Run: pip install openai")
-    exit(1)
+    def _json_loads(data):
+        return json.loads(data)
+
+    def _json_dumps(obj, indent: bool = False) -> bytes:
+        return json.dumps(obj, indent=2 if indent else None).encode('utf-8')
 
 # Configure logging
 logging.basicConfig(
@@ -35,15 +54,350 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Numeric severity ranking used for alert-threshold comparisons
+SEVERITY_LEVELS = {
+    'none': 0,
+    'low': 1,
+    'medium': 2,
+    'high': 3,
+    'critical': 4,
+    'error': 4
+}
+
+# Severity display tables (shared by email subject and both body variants)
+SEVERITY_JA = {
+    'NONE': '正常',
+    'LOW': '低',
+    'MEDIUM': '中',
+    'HIGH': '高',
+    'CRITICAL': '緊急',
+    'ERROR': 'エラー'
+}
+EMOJI_MAP = {
+    'NONE': '✅',
+    'LOW': '📋',
+    'MEDIUM': '⚠️',
+    'HIGH': '🔴',
+    'CRITICAL': '🚨',
+    'ERROR': '❌'
+}
+STATS_JA = {
+    'ssh_attempts': 'SSH試行回数',
+    'blocked_ips': 'ブロックされたIP数',
+    'disk_usage_percent': 'ディスク使用率(%)',
+    'errors_count': 'エラー数'
+}
+
+# Maximum characters of logwatch output included in the prompt (token-limit guard)
+MAX_PROMPT_LOG_CHARS = 8000
+
+# Bytes of logwatch output retained in memory for analysis; the full report
+# is always streamed to logwatch_output_file on disk regardless of size
+MAX_CAPTURE_BYTES = 256 * 1024
+
+# Wall-clock budget for the logwatch subprocess, covering the whole stream;
+# a hung run must not hold the lock and silence every later cron run
+LOGWATCH_TIMEOUT_SECONDS = 60
+
+# Rough prompt+completion token budget per request, used against the
+# x-ratelimit-remaining-tokens header to decide whether to wait
+MIN_TOKEN_HEADROOM = 4000
+
+# Cheap substring pre-filter: if none of these appear (case-insensitively)
+# in the logwatch output, the report is routine scan noise and the API call
+# can be skipped entirely. Mirrors the "really serious" list in the prompt;
+# a false positive only costs one API call, so the keywords err broad.
+INTEREST_KEYWORDS = (
+    'panic',
+    'oom',
+    'out of memory',
+    'segfault',
+    'accepted password for root',
+    'accepted publickey for root',
+    'session opened for user root',
+    'read-only file system',
+    'i/o error',
+    'filesystem error',
+    'corrupt',
+    'crash',
+    'emergency',
+    'fatal',
+)
+
+# Disk usage at or above this percentage is critical per the prompt rules;
+# checked locally because the keyword prefilter cannot see usage ratios
+DISK_USAGE_ALERT_PERCENT = 85
+DF_USAGE_RE = re.compile(r'(\d+)%')
+
+# OpenAI reset headers look like '1s', '6m12s' or '250ms'
+RESET_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+
+# Email body templates. Compiled once per process on first use (see
+# _get_email_templates); both variants share the same conditional-section
+# structure so the HTML and plain-text reports can never drift apart.
+HTML_EMAIL_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <style>
+        body { font-family: 'Hiragino Sans', 'Yu Gothic', Arial, sans-serif; line-height: 1.6; }
+        .header { background: {{ header_color }};
+                   padding: 15px; border-radius: 5px; margin-bottom: 20px; }
+        .severity { font-size: 24px; font-weight: bold; }
+        .section { margin: 20px 0; }
+        .issues { background: #f8f9fa; padding: 10px; border-left: 4px solid #dc3545; }
+        .warnings { background: #f8f9fa; padding: 10px; border-left: 4px solid #ffc107; }
+        .stats { background: #e9ecef; padding: 10px; border-radius: 5px; }
+        ul { margin: 10px 0; }
+    </style>
+</head>
+<body>
+    <div class="header">
+        <div class="severity">{{ emoji }} 重要度: {{ severity_text }}</div>
+        <div>ホスト: {{ hostname }}</div>
+        <div>日時: {{ now_str }}</div>
+    </div>
+
+    <div class="section">
+        <h2>📝 概要</h2>
+        <p>{{ analysis.get('summary', '概要情報がありません') }}</p>
+    </div>
+{% if analysis.get('critical_issues') %}
+    <div class="section issues">
+        <h3>🚨 緊急対応が必要な問題</h3>
+        <ul>
+{% for issue in analysis['critical_issues'] %}
+            <li>{{ issue }}</li>
+{% endfor %}
+        </ul>
+    </div>
+{% endif %}
+{% if analysis.get('warnings') %}
+    <div class="section warnings">
+        <h3>⚠️ 警告</h3>
+        <ul>
+{% for warning in analysis['warnings'] %}
+            <li>{{ warning }}</li>
+{% endfor %}
+        </ul>
+    </div>
+{% endif %}
+{% if analysis.get('statistics') %}
+    <div class="section stats">
+        <h3>📊 統計情報</h3>
+        <ul>
+{% for key, value in analysis['statistics'].items() %}
+            <li><strong>{{ stats_ja.get(key) or key.replace('_', ' ')|title }}:</strong> {{ value }}</li>
+{% endfor %}
+        </ul>
+    </div>
+{% endif %}
+{% if analysis.get('recommendations') %}
+    <div class="section">
+        <h3>💡 推奨対応</h3>
+        <ul>
+{% for rec in analysis['recommendations'] %}
+            <li>{{ rec }}</li>
+{% endfor %}
+        </ul>
+    </div>
+{% endif %}
+{% if show_excerpts %}
+    <div class="section">
+        <h3>📄 関連ログ詳細</h3>
+        <pre style="background: #f4f4f4; padding: 10px; border-radius: 5px; overflow-x: auto; font-size: 12px;">
+{%- for excerpt in analysis['log_excerpts'] %}{{ excerpt }}
+{% endfor %}</pre>
+    </div>
+{% endif %}
+{% if disk_info %}
+    <div class="section stats">
+        <h3>💾 ディスク容量</h3>
+        <pre style="background: #e9ecef; padding: 10px; border-radius: 5px; overflow-x: auto; font-size: 12px;">{{ disk_info }}</pre>
+    </div>
+{% endif %}
+</body>
+</html>"""
+
+TEXT_EMAIL_TEMPLATE = """{{ emoji }} LOGWATCH AI 分析結果 - {{ now_str }}
+{{ '=' * 60 }}
+ホスト: {{ hostname }}
+重要度: {{ severity_text }}
+概要: {{ analysis.get('summary', '概要情報がありません') }}
+
+{% if analysis.get('critical_issues') %}
+🚨 緊急対応が必要な問題:
+{% for issue in analysis['critical_issues'] %}
+  • {{ issue }}
+{% endfor %}
+
+{% endif %}
+{% if analysis.get('warnings') %}
+⚠️ 警告:
+{% for warning in analysis['warnings'] %}
+  • {{ warning }}
+{% endfor %}
+
+{% endif %}
+{% if analysis.get('statistics') %}
+📊 統計情報:
+{% for key, value in analysis['statistics'].items() %}
+  • {{ stats_ja.get(key) or key.replace('_', ' ')|title }}: {{ value }}
+{% endfor %}
+
+{% endif %}
+{% if analysis.get('recommendations') %}
+💡 推奨対応:
+{% for rec in analysis['recommendations'] %}
+  • {{ rec }}
+{% endfor %}
+
+{% endif %}
+{% if show_excerpts %}
+📄 関連ログ詳細:
+{{ '-' * 40 }}
+{% for excerpt in analysis['log_excerpts'] %}
+{{ excerpt }}
+{% endfor %}
+{{ '-' * 40 }}
+
+{% endif %}
+{% if disk_info %}
+💾 ディスク容量:
+{{ disk_info }}
+{% endif %}"""
+
+_email_templates = None
+
+
+def _get_email_templates():
+    """Compile both email templates once per process
+
+    Deferred so the clean-day fast path never imports jinja2; rendering a
+    compiled template is a single pass over its generated bytecode. The
+    HTML environment autoescapes, which also covers model-supplied text.
+    """
+    global _email_templates
+    if _email_templates is None:
+        try:
+            from jinja2 import Environment, BaseLoader
+        except ImportError:
+            logger.error("Jinja2 library not installed. Run: pip install jinja2")
+            raise
+        html_env = Environment(loader=BaseLoader(), autoescape=True,
+                               trim_blocks=True, lstrip_blocks=True)
+        text_env = Environment(loader=BaseLoader(), autoescape=False,
+                               trim_blocks=True, lstrip_blocks=True)
+        _email_templates = (html_env.from_string(HTML_EMAIL_TEMPLATE),
+                            text_env.from_string(TEXT_EMAIL_TEMPLATE))
+    return _email_templates
+
+
+# Logwatch delimits each service section with a banner line such as
+# " --------------------- Cron Begin ------------------------ ".
+# Compiled once at import; anchored with (?m)^ so the scan stays linear.
+SECTION_BEGIN_RE = re.compile(r'(?m)^ *-{3,} .+? Begin -{3,} *$')
+
+# How many per-section analysis requests may be in flight at once
+MAX_CONCURRENT_REQUESTS = 5
+
+# Static analysis prompt, built once at import; the logwatch output is appended per call
+ANALYSIS_PROMPT_PREFIX = """あなたはLinuxシステムセキュリティの専門家です。以下のlogwatch出力を分析し、構造化された評価を日本語で提供してください。
+
+【最重要】本当に対応が必要な問題だけを報告してください。インターネット公開サーバーで日常的に発生する事象は全て無視してください。
+
+以下は【完全に無視】してください（critical_issuesやwarningsに含めない）：
+- 失敗したSSHログイン試行（ブロック済みの攻撃）
+- 404/400/401エラーを返したHTTPリクエスト（スキャンボットは日常的）
+- /.env、/.git/config、/phpMyAdmin等への脆弱性スキャン（全て失敗している）
+- "Attempts to use known hacks"の報告（攻撃試行は失敗している）
+- mod_proxyへの接続試行
+- fail2banによるブロック
+- ディスク使用率85%未満
+- 通常のサービス再起動
+- 定期的なcronジョブ実行
+- パッケージの更新・インストール
+- 通常のメール送受信
+
+以下の【本当に重大な問題のみ】をcritical_issuesに含めてください：
+- 認証成功後の不審なアクティビティ（ログイン成功+異常操作）
+- rootや管理者での予期しないログイン成功
+- ディスク使用率85%超過
+- サービスの異常停止・クラッシュ（再起動ではなく停止）
+- カーネルパニックやOOMキラー発動
+- データベースの破損やクラッシュ
+- ファイルシステムエラー
+
+severity判定基準：
+- "none": 問題なし（日常的なスキャンのみ）
+- "low": 軽微な注意事項のみ
+- "medium": 確認が必要だが緊急ではない
+- "high": 24時間以内の対応が必要
+- "critical": 即時対応が必要
+
+JSON形式で日本語で回答してください：
+{
+    "severity": "none|low|medium|high|critical",
+    "issues_found": true|false,
+    "summary": "簡潔な一行サマリー",
+    "critical_issues": ["問題1", "問題2"],
+    "warnings": ["警告1", "警告2"],
+    "statistics": {
+        "ssh_attempts": 数値,
+        "blocked_ips": 数値,
+        "disk_usage_percent": 数値,
+        "errors_count": 数値
+    },
+    "recommendations": ["推奨アクション1", "推奨アクション2"],
+    "log_excerpts": ["重要な問題がある場合のみ、関連するログの抜粋を含める（severity が medium 以上の場合）"]
+}
+
+Logwatch出力:
+"""
+
 class LogwatchAIAnalyzer:
     """Analyzes logwatch output using AI and sends notifications"""
 
+    # Parsed user config per path, keyed by mtime so edits invalidate the
+    # entry; saves a stat+read+parse when instances are created repeatedly
+    # in a long-lived process
+    _config_cache: ClassVar[Dict[str, Tuple[int, Dict[str, Any]]]] = {}
+
     def __init__(self, config_path: str = "/etc/logwatch-ai/config.json"):
         """Initialize with configuration"""
         self.config = self.load_config(config_path)
-        self.client = OpenAI(api_key=self.config['openai_api_key'])
-        self.rate_limit_file = Path('/var/log/logwatch-ai-ratelimit.json')
+        self.rate_limit_file = Path('/var/log/logwatch-ai-ratelimit.bin')
         self.lock_file = Path('/var/lock/logwatch-ai.lock')
+        self.pending_batch_file = Path('/var/lib/logwatch-ai/pending_batch.json')
+        self.hostname = socket.gethostname()
+        self._threshold_level = SEVERITY_LEVELS.get(self.config['alert_threshold'], 2)
+        self._needs_auth = bool(self.config['smtp_user'] and self.config['smtp_password'])
+        # Server-reported rate-limit state, refreshed from each response's headers
+        self._remaining_requests: Optional[int] = None
+        self._remaining_tokens: Optional[int] = None
+        self._rate_limit_reset = 0.0
+        # Batch mode trades up to 24h of latency for 50% cost; only sensible
+        # when the alert threshold does not demand same-run delivery
+        self._use_batch = (bool(self.config['use_batch_api'])
+                           and self._threshold_level < SEVERITY_LEVELS['high'])
+        # Formatted once here (and refreshed per run()) instead of per strftime call
+        self._set_run_timestamps()
+
+    def _set_run_timestamps(self) -> None:
+        """Format the current time once for the email subject and bodies"""
+        now = datetime.now()
+        self._now_str_ja = now.strftime('%Y年%m月%d日 %H:%M:%S')
+        self._today_ja = now.strftime('%Y年%m月%d日')
+
+    @functools.cached_property
+    def client(self):
+        """OpenAI client, constructed on first API use"""
+        try:
+            from openai import AsyncOpenAI
+        except ImportError:
+            logger.error("OpenAI library not installed. Run: pip install openai")
+            raise
+        return AsyncOpenAI(api_key=self.config['openai_api_key'])
 
     def load_config(self, config_path: str) -> Dict[str, Any]:
         """Load configuration from JSON file"""
@@ -67,19 +421,47 @@ class LogwatchAIAnalyzer:
             "max_requests_per_day": 50,
             "min_interval_minutes": 5,
             "max_retries": 3,
-            "retry_delay_seconds": 30
+            "retry_delay_seconds": 30,
+            "use_batch_api": False,
+            "email_format": "auto"
         }
 
         if config_file.exists():
             try:
-                with open(config_file, 'r') as f:
-                    user_config = json.load(f)
-                    default_config.update(user_config)
+                mtime_ns = config_file.stat().st_mtime_ns
+                cache_key = str(config_file)
+                cached = self._config_cache.get(cache_key)
+
+                if cached is not None and cached[0] == mtime_ns:
+                    user_config = cached[1]
+                else:
+                    with open(config_file, 'rb') as f:
+                        user_config = _json_loads(f.read())
+                    self._config_cache[cache_key] = (mtime_ns, user_config)
+
+                default_config.update(user_config)
             except Exception as e:
                 logger.warning(f"Failed to load config from {config_path}: {e}")
 
         return default_config
 
+    @staticmethod
+    def _atomic_write_bytes(path: Path, data: bytes) -> None:
+        """Write data via a temp file + atomic rename
+
+        A crash mid-write (or a concurrent reader such as the next cron
+        run) can never observe a truncated file; the freshness-based
+        logwatch cache relies on this.
+        """
+        tmp_path = str(path) + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o600)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+
     def get_disk_usage(self) -> str:
         """Get actual disk usage information using df command"""
         try:
@@ -97,111 +479,241 @@ class LogwatchAIAnalyzer:
             return ""
 
     def run_logwatch(self) -> str:
-        """Execute logwatch and capture output"""
+        """Execute logwatch and capture output, reusing a fresh cached copy if present"""
+        output_file = Path(self.config['logwatch_output_file'])
+
+        # --range yesterday produces the same report for the whole calendar day,
+        # so an output file written since last midnight can be reused without
+        # paying for another logwatch run (the dominant wall-clock cost).
         try:
-            result = subprocess.run(
+            stat = output_file.stat()
+            midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+            if stat.st_size > 0 and stat.st_mtime >= midnight.timestamp():
+                logger.info(f"Reusing cached logwatch output from {output_file}")
+                with open(output_file, 'rb') as f:
+                    return f.read(MAX_CAPTURE_BYTES).decode('utf-8', 'replace')
+        except OSError:
+            pass  # No usable cache - run logwatch below
+
+        try:
+            # Stream stdout to disk in chunks instead of buffering a potentially
+            # multi-MB report in one str; only the analysis head stays in memory
+            proc = subprocess.Popen(
                 ['/usr/sbin/logwatch', '--output', 'stdout', '--format', 'text',
                  '--range', 'yesterday', '--detail', '10'],
-                capture_output=True,
-                text=True,
-                timeout=60
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
             )
 
-            if result.returncode != 0:
-                logger.error(f"Logwatch failed with code {result.returncode}: {result.stderr}")
+            head = bytearray()
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            # Stream into a temp file; only a successful run replaces the
+            # cached output, so readers never see a partial report. The
+            # deadline spans the whole read loop: a stalled logwatch that
+            # keeps stdout open must not block this run (and the lock) forever.
+            deadline = time.monotonic() + LOGWATCH_TIMEOUT_SECONDS
+            tmp_file = str(output_file) + '.tmp'
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o600)
+            try:
+                with open(fd, 'wb') as out:
+                    stdout_fd = proc.stdout.fileno()
+                    while True:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            proc.kill()
+                            logger.error(f"Logwatch timed out after {LOGWATCH_TIMEOUT_SECONDS} seconds")
+                            os.unlink(tmp_file)
+                            return ""
+                        ready, _, _ = select.select([stdout_fd], [], [], remaining)
+                        if not ready:
+                            continue  # deadline check above will fire
+                        chunk = os.read(stdout_fd, 65536)
+                        if not chunk:
+                            break
+                        out.write(chunk)
+                        if len(head) < MAX_CAPTURE_BYTES:
+                            head += chunk[:MAX_CAPTURE_BYTES - len(head)]
+                    out.flush()
+                    os.fsync(out.fileno())
+            except Exception:
+                os.unlink(tmp_file)
+                raise
+
+            try:
+                returncode = proc.wait(timeout=max(deadline - time.monotonic(), 1))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                logger.error("Logwatch did not exit after closing stdout")
+                os.unlink(tmp_file)
                 return ""
 
-            # Save raw output for debugging
-            output_file = Path(self.config['logwatch_output_file'])
-            output_file.parent.mkdir(parents=True, exist_ok=True)
-            output_file.write_text(result.stdout)
+            if returncode != 0:
+                logger.error(f"Logwatch failed with code {returncode}")
+                os.unlink(tmp_file)
+                return ""
 
-            return result.stdout
+            os.replace(tmp_file, output_file)
+            return head.decode('utf-8', 'replace')
 
         except Exception as e:
             logger.error(f"Failed to run logwatch: {e}")
             return ""
 
-    def check_rate_limits(self) -> bool:
-        """Check if we're within rate limits to prevent API abuse"""
-        now = datetime.now()
+    def check_rate_limits(self, count: int = 1) -> int:
+        """Check if we're within rate limits to prevent API abuse
+
+        Requests up to count slots and returns how many were granted
+        (0 when rate-limited), recording one timestamp per granted slot so
+        multi-chunk analyses are charged per real API request.
+        """
+        now_ts = time.time()
+
+        # Remove the JSON store used before the binary format; upgraded hosts
+        # would otherwise keep a dead logwatch-ai-ratelimit.json forever
+        try:
+            self.rate_limit_file.with_suffix('.json').unlink(missing_ok=True)
+        except OSError:
+            pass
 
-        # Load existing rate limit data
-        rate_data = {"requests": []}
+        # Load existing request timestamps (packed doubles, epoch seconds)
+        timestamps = array.array('d')
         if self.rate_limit_file.exists():
             try:
-                with open(self.rate_limit_file, 'r') as f:
-                    rate_data = json.load(f)
+                buf = self.rate_limit_file.read_bytes()
+                # Ignore a trailing partial record from an interrupted write
+                timestamps.frombytes(buf[:len(buf) - len(buf) % timestamps.itemsize])
             except Exception as e:
                 logger.warning(f"Failed to load rate limit data: {e}")
 
         # Clean up old entries (older than 24 hours)
-        cutoff_time = (now - timedelta(days=1)).isoformat()
-        rate_data["requests"] = [
-            req for req in rate_data["requests"]
-            if req > cutoff_time
-        ]
-
-        # Check minimum interval since last request
-        if rate_data["requests"]:
-            last_request = datetime.fromisoformat(rate_data["requests"][-1])
-            time_since_last = (now - last_request).total_seconds() / 60
-
-            if time_since_last < self.config["min_interval_minutes"]:
-                remaining = self.config["min_interval_minutes"] - time_since_last
+        cutoff = now_ts - 86400
+        timestamps = array.array('d', (t for t in timestamps if t > cutoff))
+
+        # Check minimum interval since last request (all math in epoch seconds;
+        # only the log message converts back to minutes)
+        if timestamps:
+            min_interval = self.config["min_interval_minutes"] * 60
+            since_last = now_ts - timestamps[-1]
+
+            if since_last < min_interval:
+                remaining = (min_interval - since_last) / 60
                 logger.warning(f"Rate limit: minimum interval not met. Wait {remaining:.1f} more minutes.")
-                return False
+                return 0
 
         # Check hourly limit
-        hour_ago = (now - timedelta(hours=1)).isoformat()
-        hour_requests = sum(1 for req in rate_data["requests"] if req > hour_ago)
+        hour_ago = now_ts - 3600
+        hour_requests = sum(1 for t in timestamps if t > hour_ago)
+        hourly_remaining = self.config["max_requests_per_hour"] - hour_requests
 
-        if hour_requests >= self.config["max_requests_per_hour"]:
+        if hourly_remaining <= 0:
             logger.warning(f"Rate limit: hourly limit ({self.config['max_requests_per_hour']}) reached")
-            return False
+            return 0
 
         # Check daily limit
-        day_requests = len(rate_data["requests"])
+        daily_remaining = self.config["max_requests_per_day"] - len(timestamps)
 
-        if day_requests >= self.config["max_requests_per_day"]:
+        if daily_remaining <= 0:
             logger.warning(f"Rate limit: daily limit ({self.config['max_requests_per_day']}) reached")
-            return False
+            return 0
 
-        # Add current request to rate limit data
-        rate_data["requests"].append(now.isoformat())
+        # Grant what the budget allows and record one entry per slot
+        granted = min(count, hourly_remaining, daily_remaining)
+        timestamps.extend([now_ts] * granted)
 
         # Save updated rate limit data
         try:
             self.rate_limit_file.parent.mkdir(parents=True, exist_ok=True)
-            with open(self.rate_limit_file, 'w') as f:
-                json.dump(rate_data, f)
+            self._atomic_write_bytes(self.rate_limit_file, timestamps.tobytes())
         except Exception as e:
             logger.error(f"Failed to save rate limit data: {e}")
 
-        return True
+        return granted
 
     def acquire_lock(self) -> Optional[Any]:
-        """Acquire a file lock to prevent concurrent runs"""
+        """Acquire a file lock to prevent concurrent runs
+
+        Uses a POSIX record lock (lockf) rather than flock so the lock is
+        honored across NFS/shared filesystems, where flock is unreliable.
+        """
         try:
             self.lock_file.parent.mkdir(parents=True, exist_ok=True)
-            lock_fd = open(self.lock_file, 'w')
-            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-            return lock_fd
+            # Open without O_TRUNC: a losing contender must not erase the
+            # holder's recorded PID while failing to take the lock
+            fd = os.open(self.lock_file, os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        except OSError as e:
+            logger.error(f"Failed to open lock file: {e}")
+            return None
+
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
         except (IOError, OSError):
+            os.close(fd)
             logger.error("Another instance is already running. Exiting to prevent duplicate API calls.")
             return None
 
+        # Lock held: now record our PID so a stale lock is easy to diagnose
+        os.ftruncate(fd, 0)
+        os.write(fd, f'{os.getpid()}\n'.encode())
+        os.fsync(fd)
+        return os.fdopen(fd, 'w')
+
     def release_lock(self, lock_fd):
         """Release the file lock"""
         if lock_fd:
             try:
-                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+                fcntl.lockf(lock_fd, fcntl.LOCK_UN)
                 lock_fd.close()
             except Exception as e:
                 logger.warning(f"Failed to release lock: {e}")
 
-    def analyze_with_ai(self, log_content: str) -> Dict[str, Any]:
-        """Analyze log content using OpenAI API with rate limiting and retries"""
+    @staticmethod
+    def _parse_reset_duration(value: str) -> float:
+        """Convert an x-ratelimit-reset-* header ('1s', '6m12s', '250ms') to seconds"""
+        seconds = 0.0
+        for amount, unit in RESET_DURATION_RE.findall(value):
+            seconds += float(amount) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+        return seconds
+
+    def _update_rate_limit_state(self, headers) -> None:
+        """Record the server's remaining request/token budget from response headers"""
+        try:
+            remaining_requests = headers.get('x-ratelimit-remaining-requests')
+            remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+            if remaining_requests is not None:
+                self._remaining_requests = int(remaining_requests)
+            if remaining_tokens is not None:
+                self._remaining_tokens = int(remaining_tokens)
+            self._rate_limit_reset = max(
+                self._parse_reset_duration(headers.get(name, ''))
+                for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')
+            )
+        except (TypeError, ValueError) as e:
+            logger.debug(f"Could not parse rate limit headers: {e}")
+
+    async def _wait_for_capacity(self) -> None:
+        """Sleep until the server-reported budget allows another request
+
+        Waiting for the advertised reset avoids firing a request that is
+        guaranteed to come back as a 429 and burn a retry attempt.
+        """
+        exhausted = (
+            self._remaining_requests == 0
+            or (self._remaining_tokens is not None
+                and self._remaining_tokens < MIN_TOKEN_HEADROOM)
+        )
+        if exhausted and self._rate_limit_reset > 0:
+            logger.info(f"API budget exhausted; waiting {self._rate_limit_reset:.1f}s for reset")
+            await asyncio.sleep(self._rate_limit_reset)
+            self._remaining_requests = None
+            self._remaining_tokens = None
+
+    async def analyze_with_ai(self, log_content: str) -> Dict[str, Any]:
+        """Analyze log content using OpenAI API with rate limiting and retries
+
+        Output that fits the prompt budget is analyzed in one request;
+        anything larger is split by logwatch section and the chunks are
+        analyzed concurrently under a semaphore, then merged.
+        """
 
         if not log_content:
             return {
@@ -212,76 +724,147 @@ class LogwatchAIAnalyzer:
                 "recommendations": []
             }
 
-        # Check rate limits before making API call
-        if not self.check_rate_limits():
-            return {
-                "severity": "error",
-                "issues_found": True,
-                "summary": "レート制限超過 - API過剰利用防止のためスキップしました",
-                "critical_issues": ["レート制限保護が作動しました"],
-                "warnings": [],
-                "statistics": {},
-                "recommendations": ["次回実行まで待つか、設定でレート制限を調整してください"]
-            }
-
-        prompt = f"""あなたはLinuxシステムセキュリティの専門家です。以下のlogwatch出力を分析し、構造化された評価を日本語で提供してください。
-
-【最重要】本当に対応が必要な問題だけを報告してください。インターネット公開サーバーで日常的に発生する事象は全て無視してください。
-
-以下は【完全に無視】してください（critical_issuesやwarningsに含めない）：
-- 失敗したSSHログイン試行（ブロック済みの攻撃）
-- 404/400/401エラーを返したHTTPリクエスト（スキャンボットは日常的）
-- /.env、/.git/config、/phpMyAdmin等への脆弱性スキャン（全て失敗している）
-- "Attempts to use known hacks"の報告（攻撃試行は失敗している）
-- mod_proxyへの接続試行
-- fail2banによるブロック
-- ディスク使用率85%未満
-- 通常のサービス再起動
-- 定期的なcronジョブ実行
-- パッケージの更新・インストール
-- 通常のメール送受信
-
-以下の【本当に重大な問題のみ】をcritical_issuesに含めてください：
-- 認証成功後の不審なアクティビティ（ログイン成功+異常操作）
-- rootや管理者での予期しないログイン成功
-- ディスク使用率85%超過
-- サービスの異常停止・クラッシュ（再起動ではなく停止）
-- カーネルパニックやOOMキラー発動
-- データベースの破損やクラッシュ
-- ファイルシステムエラー
-
-severity判定基準：
-- "none": 問題なし（日常的なスキャンのみ）
-- "low": 軽微な注意事項のみ
-- "medium": 確認が必要だが緊急ではない
-- "high": 24時間以内の対応が必要
-- "critical": 即時対応が必要
-
-JSON形式で日本語で回答してください：
-{{
-    "severity": "none|low|medium|high|critical",
-    "issues_found": true|false,
-    "summary": "簡潔な一行サマリー",
-    "critical_issues": ["問題1", "問題2"],
-    "warnings": ["警告1", "警告2"],
-    "statistics": {{
-        "ssh_attempts": 数値,
-        "blocked_ips": 数値,
-        "disk_usage_percent": 数値,
-        "errors_count": 数値
-    }},
-    "recommendations": ["推奨アクション1", "推奨アクション2"],
-    "log_excerpts": ["重要な問題がある場合のみ、関連するログの抜粋を含める（severity が medium 以上の場合）"]
-}}
+        # Short outputs fit a single prompt; longer ones are split by logwatch
+        # section and analyzed concurrently, then merged. Rate-limit slots are
+        # charged per real API request, so chunking cannot multiply spend
+        # beyond the configured hourly/daily caps.
+        if len(log_content) <= MAX_PROMPT_LOG_CHARS:
+            if not self.check_rate_limits():
+                return self._rate_limited_analysis()
+            return await self._request_analysis(ANALYSIS_PROMPT_PREFIX + log_content)
+
+        chunks = self._chunk_sections(log_content)
+        granted = self.check_rate_limits(len(chunks))
+        if not granted:
+            return self._rate_limited_analysis()
+        if granted < len(chunks):
+            logger.warning(f"Rate limit budget allows {granted} of {len(chunks)} chunks; analyzing the first {granted}")
+            chunks = chunks[:granted]
+
+        logger.info(f"Log output exceeds prompt budget; analyzing {len(chunks)} chunks concurrently")
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+        async def analyze_chunk(chunk: str) -> Dict[str, Any]:
+            async with semaphore:
+                return await self._request_analysis(ANALYSIS_PROMPT_PREFIX + chunk)
+
+        results = await asyncio.gather(*(analyze_chunk(chunk) for chunk in chunks))
+        return self._merge_analyses(results)
+
+    @staticmethod
+    def _rate_limited_analysis() -> Dict[str, Any]:
+        """Analysis result reported when the local rate limiter blocks a run"""
+        return {
+            "severity": "error",
+            "issues_found": True,
+            "summary": "レート制限超過 - API過剰利用防止のためスキップしました",
+            "critical_issues": ["レート制限保護が作動しました"],
+            "warnings": [],
+            "statistics": {},
+            "recommendations": ["次回実行まで待つか、設定でレート制限を調整してください"]
+        }
 
-Logwatch出力:
-{log_content[:8000]}"""  # Limit to avoid token limits
+    def _split_sections(self, log_content: str) -> List[str]:
+        """Split logwatch output into per-service sections by banner offsets
+
+        finditer yields match offsets, so sections are sliced directly from
+        the original string without intermediate splitting allocations.
+        """
+        starts = [m.start() for m in SECTION_BEGIN_RE.finditer(log_content)]
+        if not starts:
+            return [log_content]
+
+        sections = []
+        if starts[0] > 0:
+            sections.append(log_content[:starts[0]])  # header/preamble
+        for begin, end in zip(starts, starts[1:] + [len(log_content)]):
+            sections.append(log_content[begin:end])
+        return sections
+
+    def _chunk_sections(self, log_content: str) -> List[str]:
+        """Pack consecutive sections into chunks within the prompt budget"""
+        chunks = []
+        current: List[str] = []
+        current_len = 0
+
+        for section in self._split_sections(log_content):
+            if len(section) > MAX_PROMPT_LOG_CHARS:
+                section = section[:MAX_PROMPT_LOG_CHARS]
+            if current and current_len + len(section) > MAX_PROMPT_LOG_CHARS:
+                chunks.append(''.join(current))
+                current, current_len = [], 0
+            current.append(section)
+            current_len += len(section)
+
+        if current:
+            chunks.append(''.join(current))
+        return chunks
+
+    def _merge_analyses(self, results: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Combine per-chunk analyses into one report (worst severity wins)"""
+        merged: Dict[str, Any] = {
+            "severity": "none",
+            "issues_found": False,
+            "summary": "",
+            "critical_issues": [],
+            "warnings": [],
+            "statistics": {},
+            "recommendations": [],
+            "log_excerpts": []
+        }
+        summaries = []
+
+        for result in results:
+            severity = result.get('severity', 'none')
+            if SEVERITY_LEVELS.get(severity, 0) > SEVERITY_LEVELS.get(merged['severity'], 0):
+                merged['severity'] = severity
+            merged['issues_found'] = merged['issues_found'] or bool(result.get('issues_found'))
+            if result.get('summary'):
+                summaries.append(result['summary'])
+            for key in ('critical_issues', 'warnings', 'recommendations', 'log_excerpts'):
+                merged[key].extend(result.get(key) or [])
+            for key, value in (result.get('statistics') or {}).items():
+                if key == 'disk_usage_percent':
+                    merged['statistics'][key] = max(merged['statistics'].get(key, 0), value)
+                elif isinstance(value, (int, float)):
+                    merged['statistics'][key] = merged['statistics'].get(key, 0) + value
+                else:
+                    merged['statistics'].setdefault(key, value)
+
+        merged['summary'] = ' / '.join(summaries) or '分析結果がありません'
+        return merged
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """Backoff for a failed API call: server Retry-After if given, else full jitter
+
+        Full jitter desynchronizes the many hosts whose cron jobs fire at
+        the same minute and share one org's rate budget; a deterministic
+        2**attempt schedule keeps them colliding on every retry.
+        """
+        response = getattr(error, 'response', None)
+        if response is not None:
+            retry_after = response.headers.get('retry-after')
+            if retry_after:
+                try:
+                    return float(retry_after)
+                except ValueError:
+                    pass
+        return random.uniform(0, self.config['retry_delay_seconds'] * (2 ** attempt))
+
+    async def _request_analysis(self, prompt: str) -> Dict[str, Any]:
+        """Issue one analysis request with retries and exponential backoff"""
+        # Resolve the client before the retry loop: a missing openai install
+        # must fail fast, not be retried as a transient API error
+        client = self.client
 
         # Retry logic with exponential backoff
         last_error = None
         for attempt in range(self.config['max_retries']):
             try:
-                response = self.client.chat.completions.create(
+                # Respect the server's advertised budget before spending a request
+                await self._wait_for_capacity()
+
+                raw_response = await client.chat.completions.with_raw_response.create(
                     model=self.config['openai_model'],
                     messages=[
                         {"role": "system", "content": "あなたはLinuxセキュリティの専門家です。全ての回答を必ず日本語で出力してください。英語は絶対に使用しないでください。summary、critical_issues、warnings、recommendationsの全てを日本語で記述してください。"},
@@ -292,8 +875,10 @@ Logwatch出力:
                     response_format={"type": "json_object"},
                     timeout=30  # 30 second timeout per request
                 )
+                self._update_rate_limit_state(raw_response.headers)
+                response = raw_response.parse()
 
-                result = json.loads(response.choices[0].message.content)
+                result = _json_loads(response.choices[0].message.content)
                 logger.info(f"AI Analysis complete. Severity: {result.get('severity', 'unknown')}")
                 return result
 
@@ -302,9 +887,9 @@ Logwatch出力:
                 logger.warning(f"API call attempt {attempt + 1}/{self.config['max_retries']} failed: {e}")
 
                 if attempt < self.config['max_retries'] - 1:
-                    delay = self.config['retry_delay_seconds'] * (2 ** attempt)  # Exponential backoff
-                    logger.info(f"Retrying in {delay} seconds...")
-                    time.sleep(delay)
+                    delay = self._retry_delay(e, attempt)
+                    logger.info(f"Retrying in {delay:.1f} seconds...")
+                    await asyncio.sleep(delay)
 
         # All retries failed
         logger.error(f"All API retry attempts failed. Last error: {last_error}")
@@ -318,260 +903,218 @@ Logwatch出力:
             "recommendations": ["Check OpenAI API key, connectivity, and rate limits"]
         }
 
-    def should_send_alert(self, analysis: Dict[str, Any]) -> bool:
-        """Determine if an alert should be sent based on analysis"""
-        if self.config['always_send_summary']:
-            return True
-
-        severity = analysis.get('severity', 'none')
-        threshold = self.config['alert_threshold']
-
-        severity_levels = {
-            'none': 0,
-            'low': 1,
-            'medium': 2,
-            'high': 3,
-            'critical': 4,
-            'error': 4
+    def prefilter_needs_ai(self, log_content: str) -> bool:
+        """Decide locally whether the output contains anything worth an API call
+
+        A plain substring scan over the lowercased report is orders of
+        magnitude cheaper than the LLM round-trip it replaces on clean days.
+        """
+        lowered = log_content.lower()
+        return any(keyword in lowered for keyword in INTEREST_KEYWORDS)
+
+    def disk_usage_critical(self, disk_info: str) -> bool:
+        """Check df output locally for the >85% usage the prompt treats as critical
+
+        The keyword prefilter cannot trip on a usage ratio, so a report whose
+        only anomaly is a nearly full filesystem must still reach the model.
+        """
+        return any(int(match.group(1)) >= DISK_USAGE_ALERT_PERCENT
+                   for match in DF_USAGE_RE.finditer(disk_info))
+
+    async def submit_batch(self, log_content: str) -> Optional[str]:
+        """Submit the analysis prompt through the Batch API (50% cost, <=24h turnaround)
+
+        The batch id is persisted so the next cron run can collect the result.
+        Returns the batch id, or None on failure.
+        """
+        if len(log_content) > MAX_PROMPT_LOG_CHARS:
+            log_content = log_content[:MAX_PROMPT_LOG_CHARS]
+
+        request_line = {
+            "custom_id": f"logwatch-{datetime.now().strftime('%Y%m%d')}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": self.config['openai_model'],
+                "messages": [
+                    {"role": "system", "content": "あなたはLinuxセキュリティの専門家です。全ての回答を必ず日本語で出力してください。英語は絶対に使用しないでください。summary、critical_issues、warnings、recommendationsの全てを日本語で記述してください。"},
+                    {"role": "user", "content": ANALYSIS_PROMPT_PREFIX + log_content}
+                ],
+                "max_completion_tokens": 1000,
+                "response_format": {"type": "json_object"}
+            }
         }
 
-        return severity_levels.get(severity, 0) >= severity_levels.get(threshold, 2)
+        try:
+            input_file = await self.client.files.create(
+                file=("logwatch-batch.jsonl", _json_dumps(request_line) + b"\n"),
+                purpose="batch"
+            )
+            batch = await self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
 
-    def format_email_body(self, analysis: Dict[str, Any], disk_info: str = "", html: bool = True) -> str:
-        """Format analysis results for email"""
-        severity = analysis.get('severity', 'unknown').upper()
-        severity_ja = {
-            'NONE': '正常',
-            'LOW': '低',
-            'MEDIUM': '中',
-            'HIGH': '高',
-            'CRITICAL': '緊急',
-            'ERROR': 'エラー'
-        }
-        emoji_map = {
-            'NONE': '✅',
-            'LOW': '📋',
-            'MEDIUM': '⚠️',
-            'HIGH': '🔴',
-            'CRITICAL': '🚨',
-            'ERROR': '❌'
-        }
-        emoji = emoji_map.get(severity, '❓')
-        severity_text = severity_ja.get(severity, severity)
-        hostname = socket.gethostname()
+            self.pending_batch_file.parent.mkdir(parents=True, exist_ok=True)
+            self._atomic_write_bytes(self.pending_batch_file, _json_dumps({
+                "batch_id": batch.id,
+                "submitted_at": time.time()
+            }))
+            logger.info(f"Submitted analysis batch {batch.id}")
+            return batch.id
 
-        if html:
-            body = f"""<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <style>
-        body {{ font-family: 'Hiragino Sans', 'Yu Gothic', Arial, sans-serif; line-height: 1.6; }}
-        .header {{ background: {'#d4edda' if severity == 'NONE' else '#f8d7da' if severity in ['HIGH', 'CRITICAL'] else '#fff3cd'};
-                   padding: 15px; border-radius: 5px; margin-bottom: 20px; }}
-        .severity {{ font-size: 24px; font-weight: bold; }}
-        .section {{ margin: 20px 0; }}
-        .issues {{ background: #f8f9fa; padding: 10px; border-left: 4px solid #dc3545; }}
-        .warnings {{ background: #f8f9fa; padding: 10px; border-left: 4px solid #ffc107; }}
-        .stats {{ background: #e9ecef; padding: 10px; border-radius: 5px; }}
-        ul {{ margin: 10px 0; }}
-    </style>
-</head>
-<body>
-    <div class="header">
-        <div class="severity">{emoji} 重要度: {severity_text}</div>
-        <div>ホスト: {hostname}</div>
-        <div>日時: {datetime.now().strftime('%Y年%m月%d日 %H:%M:%S')}</div>
-    </div>
+        except Exception as e:
+            logger.error(f"Failed to submit batch: {e}")
+            return None
 
-    <div class="section">
-        <h2>📝 概要</h2>
-        <p>{analysis.get('summary', '概要情報がありません')}</p>
-    </div>
-"""
+    async def _run_batch_cycle(self, log_content: str, needs_ai: bool) -> Optional[Dict[str, Any]]:
+        """Collect yesterday's batch and queue today's under one event loop
 
-            if analysis.get('critical_issues'):
-                body += """
-    <div class="section issues">
-        <h3>🚨 緊急対応が必要な問題</h3>
-        <ul>"""
-                for issue in analysis['critical_issues']:
-                    body += f"\n            <li>{issue}</li>"
-                body += """
-        </ul>
-    </div>"""
+        Both steps must share a single asyncio.run: the cached AsyncOpenAI
+        client pools httpx keepalive connections, and a connection opened in
+        one (closed) loop fails with "Event loop is closed" in the next.
+        """
+        analysis = await self.collect_batch_result()
 
-            if analysis.get('warnings'):
-                body += """
-    <div class="section warnings">
-        <h3>⚠️ 警告</h3>
-        <ul>"""
-                for warning in analysis['warnings']:
-                    body += f"\n            <li>{warning}</li>"
-                body += """
-        </ul>
-    </div>"""
+        if needs_ai and not self.pending_batch_file.exists() and self.check_rate_limits():
+            await self.submit_batch(log_content)
 
-            if analysis.get('statistics'):
-                body += """
-    <div class="section stats">
-        <h3>📊 統計情報</h3>
-        <ul>"""
-                stats_ja = {
-                    'ssh_attempts': 'SSH試行回数',
-                    'blocked_ips': 'ブロックされたIP数',
-                    'disk_usage_percent': 'ディスク使用率(%)',
-                    'errors_count': 'エラー数'
-                }
-                for key, value in analysis['statistics'].items():
-                    label = stats_ja.get(key, key.replace('_', ' ').title())
-                    body += f"\n            <li><strong>{label}:</strong> {value}</li>"
-                body += """
-        </ul>
-    </div>"""
+        return analysis
 
-            if analysis.get('recommendations'):
-                body += """
-    <div class="section">
-        <h3>💡 推奨対応</h3>
-        <ul>"""
-                for rec in analysis['recommendations']:
-                    body += f"\n            <li>{rec}</li>"
-                body += """
-        </ul>
-    </div>"""
+    async def collect_batch_result(self) -> Optional[Dict[str, Any]]:
+        """Fetch the analysis from a previously submitted batch, if it finished
 
-            # ログ詳細（重要な問題がある場合のみ）
-            if analysis.get('log_excerpts') and severity in ['MEDIUM', 'HIGH', 'CRITICAL', 'ERROR']:
-                body += """
-    <div class="section">
-        <h3>📄 関連ログ詳細</h3>
-        <pre style="background: #f4f4f4; padding: 10px; border-radius: 5px; overflow-x: auto; font-size: 12px;">"""
-                for excerpt in analysis['log_excerpts']:
-                    import html as html_module
-                    body += html_module.escape(str(excerpt)) + "\n"
-                body += """</pre>
-    </div>"""
-
-            # ディスク容量情報（毎回表示）
-            if disk_info:
-                body += """
-    <div class="section stats">
-        <h3>💾 ディスク容量</h3>
-        <pre style="background: #e9ecef; padding: 10px; border-radius: 5px; overflow-x: auto; font-size: 12px;">"""
-                import html as html_module
-                body += html_module.escape(disk_info)
-                body += """</pre>
-    </div>"""
+        Returns the parsed analysis dict, or None if there is no pending
+        batch, it is still running, or it failed (terminal failures clear
+        the pending marker so the next run can submit again).
+        """
+        if not self.pending_batch_file.exists():
+            return None
 
-            body += """
-</body>
-</html>"""
+        try:
+            pending = _json_loads(self.pending_batch_file.read_bytes())
+            batch = await self.client.batches.retrieve(pending['batch_id'])
+        except Exception as e:
+            logger.error(f"Failed to check pending batch: {e}")
+            return None
+
+        if batch.status != 'completed':
+            if batch.status in ('failed', 'expired', 'cancelled'):
+                logger.error(f"Batch {batch.id} ended as {batch.status}")
+                self.pending_batch_file.unlink(missing_ok=True)
+            else:
+                logger.info(f"Batch {batch.id} still {batch.status}; will check again next run")
+            return None
+
+        try:
+            content = await self.client.files.content(batch.output_file_id)
+            payload = _json_loads(content.text.splitlines()[0])
+            message = payload['response']['body']['choices'][0]['message']['content']
+            analysis = _json_loads(message)
+            self.pending_batch_file.unlink(missing_ok=True)
+            logger.info(f"Collected batch analysis. Severity: {analysis.get('severity', 'unknown')}")
+            return analysis
+        except Exception as e:
+            logger.error(f"Failed to read batch results: {e}")
+            return None
+
+    def should_send_alert(self, analysis: Dict[str, Any]) -> bool:
+        """Determine if an alert should be sent based on analysis"""
+        if self.config['always_send_summary']:
+            return True
+
+        severity = analysis.get('severity', 'none')
+        return SEVERITY_LEVELS.get(severity, 0) >= self._threshold_level
+
+    def format_email_body(self, analysis: Dict[str, Any], emoji: str, severity_text: str,
+                          disk_info: str = "", html: bool = True) -> str:
+        """Format analysis results for email
+
+        Both variants render from pre-compiled Jinja2 templates sharing one
+        context, so the conditional-section logic lives in exactly one place.
+        The severity emoji/text are computed once by the caller so the
+        plain-text and HTML renderings share the same header values.
+        """
+        severity = analysis.get('severity', 'unknown').upper()
+        html_template, text_template = _get_email_templates()
+        template = html_template if html else text_template
+
+        return template.render(
+            analysis=analysis,
+            emoji=emoji,
+            severity_text=severity_text,
+            hostname=self.hostname,
+            now_str=self._now_str_ja,
+            disk_info=disk_info,
+            stats_ja=STATS_JA,
+            header_color=('#d4edda' if severity == 'NONE'
+                          else '#f8d7da' if severity in ('HIGH', 'CRITICAL')
+                          else '#fff3cd'),
+            show_excerpts=(bool(analysis.get('log_excerpts'))
+                           and severity in ('MEDIUM', 'HIGH', 'CRITICAL', 'ERROR'))
+        )
+
+    @contextmanager
+    def _smtp_session(self):
+        """Yield a connected (and authenticated, if configured) SMTP session
+
+        Keeping connection setup in one place lets callers send several
+        messages over a single TLS handshake + AUTH exchange.
+        """
+        import smtplib
+
+        # Port 465 uses SSL, not STARTTLS
+        if self.config['smtp_port'] == 465:
+            smtp = smtplib.SMTP_SSL(self.config['smtp_host'], self.config['smtp_port'])
         else:
-            # Plain text version
-            body = f"""{emoji} LOGWATCH AI 分析結果 - {datetime.now().strftime('%Y年%m月%d日 %H:%M:%S')}
-{'=' * 60}
-ホスト: {hostname}
-重要度: {severity_text}
-概要: {analysis.get('summary', '概要情報がありません')}
+            smtp = smtplib.SMTP(self.config['smtp_host'], self.config['smtp_port'])
+            if self.config['smtp_use_tls']:
+                smtp.starttls()
 
-"""
-            if analysis.get('critical_issues'):
-                body += "🚨 緊急対応が必要な問題:\n"
-                for issue in analysis['critical_issues']:
-                    body += f"  • {issue}\n"
-                body += "\n"
-
-            if analysis.get('warnings'):
-                body += "⚠️ 警告:\n"
-                for warning in analysis['warnings']:
-                    body += f"  • {warning}\n"
-                body += "\n"
-
-            if analysis.get('statistics'):
-                body += "📊 統計情報:\n"
-                stats_ja = {
-                    'ssh_attempts': 'SSH試行回数',
-                    'blocked_ips': 'ブロックされたIP数',
-                    'disk_usage_percent': 'ディスク使用率(%)',
-                    'errors_count': 'エラー数'
-                }
-                for key, value in analysis['statistics'].items():
-                    label = stats_ja.get(key, key.replace('_', ' ').title())
-                    body += f"  • {label}: {value}\n"
-                body += "\n"
-
-            if analysis.get('recommendations'):
-                body += "💡 推奨対応:\n"
-                for rec in analysis['recommendations']:
-                    body += f"  • {rec}\n"
-                body += "\n"
-
-            # ログ詳細（重要な問題がある場合のみ）
-            if analysis.get('log_excerpts') and severity in ['MEDIUM', 'HIGH', 'CRITICAL', 'ERROR']:
-                body += "📄 関連ログ詳細:\n"
-                body += "-" * 40 + "\n"
-                for excerpt in analysis['log_excerpts']:
-                    body += f"{excerpt}\n"
-                body += "-" * 40 + "\n\n"
-
-            # ディスク容量情報（毎回表示）
-            if disk_info:
-                body += "💾 ディスク容量:\n"
-                body += disk_info + "\n"
-
-        return body
+        try:
+            if self._needs_auth:
+                smtp.login(self.config['smtp_user'], self.config['smtp_password'])
+            yield smtp
+        finally:
+            try:
+                smtp.quit()
+            except Exception:
+                smtp.close()
 
     def send_email(self, analysis: Dict[str, Any], disk_info: str = "") -> bool:
         """Send email notification"""
+        from email.mime.text import MIMEText
+        from email.mime.multipart import MIMEMultipart
+
         try:
             severity = analysis.get('severity', 'unknown').upper()
-            severity_ja = {
-                'NONE': '正常',
-                'LOW': '低',
-                'MEDIUM': '中',
-                'HIGH': '高',
-                'CRITICAL': '緊急',
-                'ERROR': 'エラー'
-            }
-            emoji_map = {
-                'NONE': '✅',
-                'LOW': '📋',
-                'MEDIUM': '⚠️',
-                'HIGH': '🔴',
-                'CRITICAL': '🚨',
-                'ERROR': '❌'
-            }
-            emoji = emoji_map.get(severity, '❓')
-            severity_text = severity_ja.get(severity, severity)
+            emoji = EMOJI_MAP.get(severity, '❓')
+            severity_text = SEVERITY_JA.get(severity, severity)
+
+            # "auto" sends plain text only when everything goes to local root
+            # mailboxes (read with text MUAs); external recipients get both
+            email_format = self.config.get('email_format', 'auto')
+            if email_format == 'auto':
+                all_root = all(addr.startswith('root@') for addr in self.config['to_emails'])
+                email_format = 'text' if all_root else 'both'
+
+            if email_format == 'both':
+                msg = MIMEMultipart('alternative')
+                msg.attach(MIMEText(self.format_email_body(analysis, emoji, severity_text, disk_info, html=False), 'plain'))
+                msg.attach(MIMEText(self.format_email_body(analysis, emoji, severity_text, disk_info, html=True), 'html'))
+            elif email_format == 'html':
+                msg = MIMEText(self.format_email_body(analysis, emoji, severity_text, disk_info, html=True), 'html')
+            else:
+                msg = MIMEText(self.format_email_body(analysis, emoji, severity_text, disk_info, html=False), 'plain')
 
-            msg = MIMEMultipart('alternative')
-            hostname = socket.gethostname()
-            msg['Subject'] = f"{emoji} [{hostname}] Logwatch AI レポート - 重要度: {severity_text} - {datetime.now().strftime('%Y年%m月%d日')}"
+            msg['Subject'] = f"{emoji} [{self.hostname}] Logwatch AI レポート - 重要度: {severity_text} - {self._today_ja}"
             msg['From'] = self.config['from_email']
             msg['To'] = ', '.join(self.config['to_emails'])
 
-            # Add both plain text and HTML versions
-            text_part = MIMEText(self.format_email_body(analysis, disk_info, html=False), 'plain')
-            html_part = MIMEText(self.format_email_body(analysis, disk_info, html=True), 'html')
-
-            msg.attach(text_part)
-            msg.attach(html_part)
-
-            # Send email
-            # Port 465 uses SSL, not STARTTLS
-            if self.config['smtp_port'] == 465:
-                smtp = smtplib.SMTP_SSL(self.config['smtp_host'], self.config['smtp_port'])
-            else:
-                smtp = smtplib.SMTP(self.config['smtp_host'], self.config['smtp_port'])
-                if self.config['smtp_use_tls']:
-                    smtp.starttls()
-
-            if self.config['smtp_user'] and self.config['smtp_password']:
-                smtp.login(self.config['smtp_user'], self.config['smtp_password'])
-
-            smtp.send_message(msg)
-            smtp.quit()
+            # Send email over a reusable session
+            with self._smtp_session() as smtp:
+                smtp.send_message(msg)
 
             logger.info(f"Email sent successfully to {self.config['to_emails']}")
             return True
@@ -583,6 +1126,7 @@ Logwatch出力:
     def run(self) -> None:
         """Main execution method with concurrency protection"""
         logger.info("Starting Logwatch AI analysis")
+        self._set_run_timestamps()
 
         # Acquire lock to prevent concurrent runs
         lock_fd = self.acquire_lock()
@@ -603,13 +1147,42 @@ Logwatch出力:
             logger.info("Getting disk usage information...")
             disk_info = self.get_disk_usage()
 
-            # Analyze with AI
-            logger.info("Analyzing logs with AI...")
-            analysis = self.analyze_with_ai(log_content)
+            # Local pre-filter: clean-day outputs never need the LLM unless a
+            # summary was explicitly requested or a filesystem is nearly full
+            needs_ai = (self.config['always_send_summary']
+                        or self.prefilter_needs_ai(log_content)
+                        or self.disk_usage_critical(disk_info))
+
+            if self._use_batch:
+                # Batch mode: report yesterday's batch (if finished), then
+                # queue today's log as the next batch at half cost
+                analysis = asyncio.run(self._run_batch_cycle(log_content, needs_ai))
+
+                if analysis is None:
+                    if not needs_ai:
+                        logger.info("Prefilter found no notable events; no batch queued")
+                    else:
+                        logger.info("No completed batch analysis to report yet")
+                    return
+            elif not needs_ai:
+                logger.info("Prefilter found no notable events; skipping AI analysis")
+                analysis = {
+                    "severity": "none",
+                    "issues_found": False,
+                    "summary": "注目すべきイベントは検出されませんでした（ローカル事前フィルター判定）",
+                    "critical_issues": [],
+                    "warnings": [],
+                    "statistics": {},
+                    "recommendations": []
+                }
+            else:
+                # Analyze with AI
+                logger.info("Analyzing logs with AI...")
+                analysis = asyncio.run(self.analyze_with_ai(log_content))
 
             # Save analysis results
             analysis_file = Path('/var/log/logwatch-ai-analysis.json')
-            analysis_file.write_text(json.dumps(analysis, indent=2))
+            self._atomic_write_bytes(analysis_file, _json_dumps(analysis, indent=True))
 
             # Send alert if needed
             if self.should_send_alert(analysis):
@@ -56,7 +56,7 @@ echo "Virtual environment created at $VENV_DIR"
 
 echo -e "${YELLOW}Installing Python dependencies...${NC}"
 "$VENV_DIR/bin/pip" install --upgrade pip --quiet
-"$VENV_DIR/bin/pip" install openai requests --quiet
+"$VENV_DIR/bin/pip" install openai requests jinja2 orjson --quiet
 echo "Dependencies installed"
 
 # Create configuration directory